@@ -1,36 +1,153 @@
 import streamlit as st
-import google.generativeai as genai
-import pdfplumber
-import json
-import re # We are no longer using re, but in case you add it back, we import it.
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import orjson
+import hashlib
+import re
 import time
+import os
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import repeat
+from tenacity import (
+    Retrying, retry_if_exception_type, stop_after_attempt, stop_when_event_set, wait_exponential_jitter,
+)
 
 # --- Configuration ---
-try:
-    GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"]
-    genai.configure(api_key=GOOGLE_API_KEY)
-    model = genai.GenerativeModel('gemini-flash-latest') # Using the model that worked
-except Exception as e:
-    st.error("Error configuring Google AI. Check your Streamlit Secrets.")
-    model = None
+MODEL_NAME = 'gemini-flash-latest' # Using the model that worked
+# Cheaper, faster model for the Cleaner, which only reformats text. Agents that write what the user reads stay on MODEL_NAME.
+LITE_MODEL_NAME = 'gemini-flash-lite-latest'
+
+@st.cache_resource
+def _build_model(model_name):
+    """
+    Configures the Gemini client and builds the model once per process, not on every rerun.
+    The SDK (and the gRPC stack under it) is imported here, so the first page paint doesn't wait for it.
+    """
+    import google.generativeai as genai
+
+    genai.configure(api_key=st.secrets["GOOGLE_API_KEY"])
+    return genai.GenerativeModel(model_name)
+
+def get_model(model_name=MODEL_NAME):
+    """
+    Returns the shared Gemini model, or None if it could not be configured.
+    Failures are not cached, so fixing the secret takes effect on the next rerun.
+    """
+    try:
+        return _build_model(model_name)
+    except Exception:
+        return None
+
+CACHED_GENERATION_CONFIG = {"temperature": 0.0}
+
+# Context window of MODEL_NAME. Token counts are estimated locally from the text length,
+# with headroom left for the prompt and the response.
+MODEL_CONTEXT_TOKENS = 1_048_576
+PROMPT_HEADROOM_TOKENS = 16_384
+CHARS_PER_TOKEN = 4
+
+# Batch jobs are billed at a discount but can take minutes (or hours) to finish,
+# so their state is polled at this interval.
+BATCH_POLL_SECONDS = 30
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+
+# Cap on Gemini requests in flight at once from one fan-out, to stay under the per-minute rate limit.
+MAX_CONCURRENT_REQUESTS = 5
+
+# Hedged requests send each JSON-producing call this many times and keep the first
+# valid response, trading extra API cost for a shorter tail latency.
+HEDGE_COPIES = 2
+
+# Extracted PDF text is persisted here, keyed by the SHA-256 of the PDF bytes.
+PDF_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pdf_cache")
+# Prefixed to those keys; bump it whenever the stored text's format changes (v2: pages joined with PAGE_BREAK).
+PDF_CACHE_FORMAT = "v2"
+
+# PDFium reads a page in a few milliseconds, so a worker process is only worth
+# starting for at least this many pages.
+MIN_PAGES_PER_WORKER = 16
+
+# Extracted pages are joined with this, so boilerplate can still be detected page by page.
+PAGE_BREAK = "\f"
+
+# --- Text Cleaning (Regexes first, the Cleaner Agent only for what they miss) ---
+# PDF extraction glues numbers, units and punctuation together ("51.2billion(up26").
+# These fixes are deterministic, so they are done with regexes instead of an LLM call.
+_CLEAN_RES = [
+    (re.compile(r"(\d*(?:(?<!1)1st|(?<!1)2nd|(?<!1)3rd|(?:1[1-3]|[04-9])th(?!ousand)))(?=[a-z]{2,})"), r"\1 "),  # 4thquarter -> 4th quarter
+    (re.compile(r"(\d)(?!(?:st|nd|rd|th)\b)([a-z]{2,})"), r"\1 \2"),  # 51.2billion -> 51.2 billion
+    (re.compile(r"([a-z]{2,})(\d)"), r"\1 \2"),                      # up26 -> up 26
+    (re.compile(r"\b(billion|million|trillion)(to|and|or|of|from|for|per)\b"), r"\1 \2"),  # billionto -> billion to
+    (re.compile(r"(\d+(?:\.\d+)?)-(\d+(?:\.\d+)?) (billion|million|trillion)\b"), r"\1 \3 to \2 \3"),  # 70-72 billion
+    (re.compile(r"%(?=[A-Za-z(])"), r"% "),                           # 26%YoY -> 26% YoY
+    (re.compile(r"\bYoY\b"), r"Y/Y"),                                # YoY -> Y/Y
+    (re.compile(r"([A-Za-z])\("), r"\1 ("),                           # billion(up -> billion (up
+    (re.compile(r"\)(?=[A-Za-z])"), r") "),                           # )Revenue -> ) Revenue
+    (re.compile(r'([a-z][.,;:!?]"?)([A-Z])'), r"\1 \2"),               # billion.Engagement -> billion. Engagement
+    (re.compile(r"([a-z][,;:])([a-z])"), r"\1 \2"),                    # revenue,which -> revenue, which
+]
+
+# Run-together words ("Engagementremainshigh") need real word segmentation, so they are
+# left to the Cleaner Agent. A letters-only run this long is almost always glued words.
+_GLUED_WORD_RE = re.compile(r"[A-Za-z]{18,}")
+# The Cleaner Agent only runs when more than this fraction of words still look glued.
+CLEANER_MESSINESS_THRESHOLD = 0.002
+# The Cleaner rewrites text piece by piece, so it works on windows of this many
+# characters, cleaned concurrently.
+CLEANER_WINDOW_CHARS = 12000
+
+# --- Boilerplate Stripping ---
+# Running headers and footers sit in the first or last few lines of a page. Such a line found on
+# at least this share of pages is dropped; it needs a few pages before "repeated" means anything.
+BOILERPLATE_EDGE_LINES = 3
+BOILERPLATE_PAGE_SHARE = 0.5
+BOILERPLATE_MIN_PAGES = 3
+# Page numbers ("12", "Page 3 of 12", "- 4 -") change every page, so they all compare alike.
+# Every other line has to repeat exactly.
+_PAGE_NUMBER_RE = re.compile(r"(?i:page\s*)?\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?|-\s*\d{1,4}\s*-")
+# Speaker labels often open a page too, but they are never boilerplate.
+_SPEAKER_LINE_RE = re.compile(r"[A-Z][a-z]+(?: [A-Z][a-z]+)*:")
+# A Safe Harbor / forward-looking statements section, from a standalone Title Case heading line
+# ("Safe Harbor Statement", "Forward-Looking Statements:") up to the next speaker turn. A sentence
+# that merely starts with those words is left alone, and the length cap keeps a heading with no
+# speaker after it from swallowing the rest of the transcript.
+_SAFE_HARBOR_RE = re.compile(
+    r"^(?:Safe Harbor|Forward-Looking Statements|Cautionary Statements?)(?: [A-Z][\w&-]*){0,5}:?\n"
+    r".{0,5000}?\n(?=[A-Z][a-z]+(?: [A-Z][a-z]+)*:)",
+    re.MULTILINE | re.DOTALL,
+)
+
+# --- Map-Reduce Analysis ---
+# Long transcripts are split at speaker turns into sections of about this size,
+# analyzed concurrently, and the per-section JSON lists are merged.
+ANALYZER_SECTION_CHARS = 24000
+ANALYZER_KEYS = ["key_numbers", "strategic_updates", "risk_factors", "red_flags"]
+# Below this many characters of Analyzer bullets, the report is laid out directly
+# instead of paying for a Synthesizer call.
+SYNTHESIZER_MIN_CHARS = 2000
+_SPEAKER_TURN_RE = re.compile(r"\n(?=[A-Z][a-z]+(?: [A-Z][a-z]+)*:)")
+
+# Joins an agent prompt to the text it should process.
+_PROMPT_SEPARATOR = "\n\nHere is the text to process:\n\n"
+
+# The tokens that matter for brace matching: whole string literals (so braces inside
+# strings are skipped) and bare braces. Everything else is stepped over by the regex engine.
+_JSON_TOKEN_RE = re.compile(r'"(?:[^"\\]|\\.)*"|[{}]')
 
 # --- Agent Prompts (The New Assembly Line) ---
 
-# Agent 1: The Cleaner (NEW)
-# Its ONLY job is to fix the messy text, using your explicit rules.
+# Agent 1: The Cleaner (Fallback)
+# Only runs in the debug pipeline, when the regexes leave too many glued words behind.
 cleaner_agent_prompt = """
-Your only job is to be a text-cleaning specialist. You will be given messy text from a PDF.
+Your only job is to be a text-cleaning specialist. You will be given text from a PDF.
+Numbers and punctuation have already been fixed, but some words are still run together.
 You must rewrite it as perfectly clean, human-readable text.
 **You MUST use these examples as a strict guide:**
 
-* `51.2billion(up26` = `$51.2 billion (up 26%)`
-* `18.6billion(7.25 per share)` = `$18.6 billion ($7.25 per share)`
-* `56billionto59billion` = `$56 billion to $59 billion`
-* `70-72 billion` = `$70 billion to $72 billion`
-* `116-118 billion` = `$116 billion to $118 billion`
-* `116billionto118billion` = `$116 billion to $118 billion`
-* `$60 billion.Engagementremainshigh` = `$60 billion. Engagement remains high`
-* `"personalsuperintelligence."Thisaggressivepivot` = `"personal superintelligence." This aggressive pivot`
+* `$60 billion. Engagementremainshigh` = `$60 billion. Engagement remains high`
+* `"personalsuperintelligence." Thisaggressivepivot` = `"personal superintelligence." This aggressive pivot`
 
 Do not summarize. Do not analyze. Do not change any numbers.
 Your only output is the clean text.
@@ -41,7 +158,7 @@ Your only output is the clean text.
 analyzer_agent_prompt = """
 Your only job and only output must be a single, valid JSON object. Do not add any text, commentary, or explanation before or after the JSON.
 
-You will be given **clean, human-readable text.**
+You will be given **mostly clean, human-readable text.** Some words may still be run together; read past that.
 Your task is to analyze this text and extract the information into these keys:
 `key_numbers`, `strategic_updates`, `risk_factors`, and `red_flags`.
 
@@ -71,47 +188,653 @@ KEY METRICS & GUIDANCE
 - Q4 Revenue Guidance: $56 billion to $59 billion.
 """
 
+# Single-pass Agent: The Report Writer
+# Does the Cleaner, Analyzer and Synthesizer jobs in one call, so the transcript is only sent once.
+report_agent_prompt = """
+You are an equity research analyst. You will be given messy text extracted from an earnings call transcript PDF.
+
+1.  Read past PDF extraction artifacts: missing spaces and symbols, e.g. `51.2billion(up26` means `$51.2 billion (up 26%)`
+    and `56billionto59billion` means `$56 billion to $59 billion`. Do not change any numbers.
+2.  Extract the facts that matter to an investor.
+3.  Return a single JSON object with these keys:
+    * `executive_summary`: a short, high-level paragraph of plain text.
+    * `key_metrics`: a list of strings, one per reported metric or guidance figure.
+    * `strategic_developments`: a list of strings, one per strategic update.
+    * `risks_and_red_flags`: a list of strings, one per risk factor or red flag.
+
+Do NOT use any Markdown in the strings. If you find no information for a list, return an empty list `[]`.
+"""
+
+REPORT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "executive_summary": {"type": "string"},
+        "key_metrics": {"type": "array", "items": {"type": "string"}},
+        "strategic_developments": {"type": "array", "items": {"type": "string"}},
+        "risks_and_red_flags": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["executive_summary", "key_metrics", "strategic_developments", "risks_and_red_flags"],
+}
+
+# --- Generation Settings (one per agent) ---
+# Deterministic sampling for the extraction and rewriting agents. The output caps sit well
+# above a normal response and only stop a runaway generation; a JSON response cut off by the
+# cap would not parse anyway.
+REPORT_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": REPORT_SCHEMA,
+    "temperature": 0.0,
+    "max_output_tokens": 4096,
+}
+
+CLEANER_GENERATION_CONFIG = {
+    "temperature": 0.0,
+    "max_output_tokens": 8192,
+}
+
+ANALYZER_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "temperature": 0.0,
+    "max_output_tokens": 4096,
+}
+
+SYNTHESIZER_GENERATION_CONFIG = {
+    "temperature": 0.2,
+    "max_output_tokens": 2048,
+}
+
 # --- Helper Functions (The "Connectors") ---
 
 def clean_json_response(response_text):
     """
     Helper function to clean the json artifacts from the AI's response.
+    Parses the first complete JSON object, ignoring any text around it
+    (so a stray brace in trailing commentary can't break it).
+    Raises ValueError (orjson.JSONDecodeError is one) if there is no valid object.
     """
-    json_start = response_text.find('{')
-    json_end = response_text.rfind('}') + 1
-    if json_start != -1 and json_end != -1:
-        return response_text[json_start:json_end]
-    else:
-        return response_text # Fallback
+    start = response_text.find("{")
+    if start != -1:
+        depth = 0
+        for token in _JSON_TOKEN_RE.finditer(response_text, start):
+            if token.group() == "{":
+                depth += 1
+            elif token.group() == "}":
+                depth -= 1
+                if depth == 0:
+                    return orjson.loads(response_text[start:token.end()])
+    result = orjson.loads(response_text) # Fallback
+    if not isinstance(result, dict):
+        raise ValueError(f"expected a JSON object, got {type(result).__name__}")
+    return result
+
+def build_report_from_json(report):
+    """
+    Renders the Report Writer's JSON object in the same plain-text layout the Synthesizer uses.
+    """
+    sections = [("EXECUTIVE SUMMARY", report.get("executive_summary", ""))]
+    for heading, key in [
+        ("KEY METRICS & GUIDANCE", "key_metrics"),
+        ("STRATEGIC DEVELOPMENTS", "strategic_developments"),
+        ("RISKS & RED FLAGS", "risks_and_red_flags"),
+    ]:
+        bullets = report.get(key) or []
+        if bullets:
+            sections.append((heading, "\n".join(f"- {bullet}" for bullet in bullets)))
 
-def call_gemini(prompt, data_to_process, retry_count=2):
+    return "\n\n".join(f"{heading}\n{body}" for heading, body in sections)
+
+def call_gemini(prompt, data_to_process, generation_config=None, model_name=MODEL_NAME):
     """
     A single, reliable function to make the Gemini API call with retries.
+    Responses are cached by a hash of the request, so re-running the same PDF costs no API calls.
     """
+    model = get_model(model_name)
     if model is None:
         return ("Error: Google Generative AI model is not configured.")
 
-    full_prompt = f"{prompt}\n\nHere is the text to process:\n\n{data_to_process}"
-
-    for attempt in range(retry_count):
-        try:
-            response = model.generate_content(full_prompt)
-            if response and response.text:
-                return response.text
-            else:
-                st.error(f"API Error (Attempt {attempt + 1}): Received empty response.")
-                time.sleep(1)
-        except Exception as e:
-            st.error(f"API Error (Attempt {attempt + 1}/{retry_count}): {e}")
-            if "quota" in str(e).lower():
-                st.error("Quota exceeded. Please check your Google AI billing.")
-                return None
-            time.sleep(1)
-    
-    st.error("Failed to get a response from the API after multiple attempts.")
+    # Greedy decoding, so a cached response is the answer the same request would get again.
+    generation_config = {**CACHED_GENERATION_CONFIG, **(generation_config or {})}
+    request_key = hashlib.sha256(
+        f"{model_name}\0{prompt}\0{data_to_process}\0{generation_config!r}".encode()
+    ).hexdigest()
+
+    # Retried out here, not inside the cached function: st.cache_data replays any UI drawn
+    # inside it (such as the retry toast) on every later cache hit.
+    try:
+        return Retrying(**_retry_policy())(
+            _cached_gemini, request_key, prompt, data_to_process, generation_config, model_name
+        )
+    except Exception as e:
+        return _report_gemini_failure(e)
+
+@st.cache_data(persist="disk", show_spinner=False)
+def _cached_gemini(request_key, _prompt, _data_to_process, _generation_config, _model_name):
+    """
+    Cached wrapper for _generate_text. Only request_key is hashed by Streamlit;
+    failures raise so they are never cached. Persisted to disk, so it survives restarts.
+    """
+    return _generate_text(_prompt, _data_to_process, _generation_config, _model_name)
+
+def _generate_text(prompt, data_to_process, generation_config, model_name):
+    """
+    One Gemini call, without retries or UI. Raises on failure, including EmptyResponseError.
+    """
+    model = get_model(model_name)
+    full_prompt = prompt + _PROMPT_SEPARATOR + data_to_process
+    return _response_text(model.generate_content(full_prompt, generation_config=generation_config))
+
+class EmptyResponseError(Exception):
+    """
+    Gemini answered without any text: blocked, or stopped (e.g. at max_output_tokens) before writing.
+    """
+
+def _response_text(response):
+    """
+    The response's text. For a blocked or empty candidate the SDK's response.text raises ValueError
+    rather than returning "", so both cases are raised as EmptyResponseError.
+    """
+    try:
+        response_text = response.text
+    except ValueError as e:
+        raise EmptyResponseError(f"Received empty response: {e}") from e
+    if not response_text:
+        raise EmptyResponseError("Received empty response.")
+    return response_text
+
+def _toast_retry(retry_state):
+    """
+    Tenacity before_sleep hook: a passing toast, so transient failures don't flash red.
+    """
+    st.toast(f"Gemini request failed, retrying (attempt {retry_state.attempt_number + 1})...")
+
+def _retry_policy(retry_on_empty=True):
+    """
+    Tenacity settings shared by every Gemini call. Transient errors (and, optionally, empty
+    responses) are retried with jittered exponential backoff; anything else fails straight away.
+    """
+    from google.api_core import exceptions as google_exceptions
+
+    # Timeouts, server-side failures, and 429s, which is also what the per-minute rate limit raises.
+    # Anything else (bad key, bad request) fails straight away.
+    retried_errors = (
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.ResourceExhausted,
+    )
+    if retry_on_empty:
+        retried_errors += (EmptyResponseError,)
+    return {
+        "wait": wait_exponential_jitter(initial=0.5, max=30),
+        "stop": stop_after_attempt(5),
+        "retry": retry_if_exception_type(retried_errors),
+        "before_sleep": _toast_retry,
+        "reraise": True,
+    }
+
+def _report_gemini_failure(error):
+    """
+    Shows why a Gemini call gave up. Returns None, for callers to pass on as their result.
+    """
+    from google.api_core import exceptions as google_exceptions
+
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        st.error("Quota or rate limit exceeded. Please check your Google AI billing.")
+    elif isinstance(error, EmptyResponseError):
+        st.error("Failed to get a response from the API after multiple attempts.")
+    else:
+        st.error(f"API Error: {error}")
     return None
 
+def stream_gemini(prompt, data_to_process, generation_config=None, model_name=MODEL_NAME):
+    """
+    Streams the Gemini response chunk by chunk, so the UI can show text as it is generated.
+    Only retries if the call fails before the first chunk arrives. Streamed responses are not cached.
+    """
+    model = get_model(model_name)
+    if model is None:
+        st.error("Google Generative AI model is not configured.")
+        return
+
+    full_prompt = prompt + _PROMPT_SEPARATOR + data_to_process
+
+    try:
+        for attempt in Retrying(**_retry_policy(retry_on_empty=False)):
+            with attempt:
+                chunks = iter(model.generate_content(full_prompt, generation_config=generation_config, stream=True))
+                first_chunk = next(chunks, None)
+    except Exception as e:
+        _report_gemini_failure(e)
+        return
+    if first_chunk is None:
+        st.error("API Error: Received empty response.")
+        return
+
+    try:
+        if first_chunk.text:
+            yield first_chunk.text
+        for chunk in chunks:
+            if chunk.text:
+                yield chunk.text
+    except Exception as e:
+        st.error(f"API Error: {e}")
+
+def _gemini_executor():
+    """
+    A thread pool for one fan-out of Gemini calls, at most MAX_CONCURRENT_REQUESTS at a time.
+    Workers are attached to the current script run, so the toasts and errors they draw reach the page.
+    """
+    return ThreadPoolExecutor(
+        max_workers=MAX_CONCURRENT_REQUESTS,
+        initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()),
+    )
+
+def gather_gemini(prompt, inputs, generation_config=None, on_done=None, model_name=MODEL_NAME):
+    """
+    Runs the same agent over several independent inputs at once, through call_gemini (and its cache).
+    Threads rather than asyncio: the SDK's async client is bound to the first event loop it ran on,
+    while the blocking client is thread-safe and shared by every run.
+    Returns the responses in input order (None for any call that failed).
+    """
+    with _gemini_executor() as executor:
+        futures = [
+            executor.submit(call_gemini, prompt, data, generation_config, model_name)
+            for data in inputs
+        ]
+        if on_done is not None:
+            for _ in as_completed(futures):
+                on_done()
+    return [future.result() for future in futures]
+
+def is_valid_json_response(response_text):
+    """
+    Checks whether a response contains a parseable JSON object.
+    """
+    try:
+        clean_json_response(response_text)
+        return True
+    except ValueError:
+        return False
+
+def _hedged_copy(prompt, data_to_process, generation_config, answered):
+    """
+    One copy of a hedged request: uncached (the cache would make copies wait on each other) and
+    silent, so only hedge_gemini reports. Stops retrying once answered is set by a sibling that won.
+    Raises the last error if it gives up.
+    """
+    generation_config = {**CACHED_GENERATION_CONFIG, **(generation_config or {})}
+    retry_policy = _retry_policy()
+    retry_policy["stop"] = retry_policy["stop"] | stop_when_event_set(answered)
+    retry_policy["before_sleep"] = None
+    return Retrying(**retry_policy)(_generate_text, prompt, data_to_process, generation_config, MODEL_NAME)
+
+def hedge_gemini(prompt, inputs, generation_config=None, on_done=None):
+    """
+    Like gather_gemini, but each input is sent HEDGE_COPIES times and the first response that
+    parses as JSON wins, so latency is the fastest of the copies. Once an input is answered, its
+    copies that haven't started are cancelled and the ones in flight stop retrying.
+    An error is shown only when every copy of an input failed.
+    """
+    executor = _gemini_executor()
+    answered = [threading.Event() for _ in inputs]
+    input_of = {}
+    copies = []
+    for index, data in enumerate(inputs):
+        copies.append([
+            executor.submit(_hedged_copy, prompt, data, generation_config, answered[index])
+            for _ in range(HEDGE_COPIES)
+        ])
+        input_of.update((future, index) for future in copies[index])
+
+    responses = [None] * len(inputs)
+    copies_left = [HEDGE_COPIES] * len(inputs)
+    last_errors = [None] * len(inputs)
+    answered_count = 0
+    try:
+        for future in as_completed(input_of):
+            index = input_of[future]
+            if answered[index].is_set():
+                continue
+            copies_left[index] -= 1
+            if future.exception() is not None:
+                last_errors[index] = future.exception()
+            elif is_valid_json_response(future.result()):
+                responses[index] = future.result()
+            if responses[index] is None and copies_left[index]:
+                continue
+            if responses[index] is None and last_errors[index] is not None:
+                _report_gemini_failure(last_errors[index])
+            answered[index].set()
+            answered_count += 1
+            for sibling in copies[index]:
+                sibling.cancel()
+            if on_done is not None:
+                on_done()
+            if answered_count == len(inputs):
+                break
+    finally:
+        for event in answered:
+            event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+    return responses
+
+def run_json_agent(prompt, inputs, generation_config=None, batch_mode=False, hedge_requests=False, on_done=None):
+    """
+    Runs a JSON-producing agent over each input, using the request mode chosen in the UI.
+    Returns the raw responses in input order (None for any call that failed).
+    on_done, if given, is called once per input as its response arrives.
+    """
+    if batch_mode:
+        responses = batch_gemini(prompt, inputs, generation_config=generation_config)
+    elif hedge_requests:
+        return hedge_gemini(prompt, inputs, generation_config=generation_config, on_done=on_done)
+    elif len(inputs) == 1:
+        responses = [call_gemini(prompt, inputs[0], generation_config=generation_config)]
+    else:
+        return gather_gemini(prompt, inputs, generation_config=generation_config, on_done=on_done)
+
+    if on_done is not None:
+        for _ in responses:
+            on_done()
+    return responses
+
+def batch_gemini(prompt, inputs, generation_config=None):
+    """
+    Runs the same agent over several inputs as one Gemini batch job and waits for it.
+    Returns the responses in input order (None for any request that failed).
+    """
+    from google.genai import Client as BatchClient
+
+    try:
+        client = BatchClient(api_key=st.secrets["GOOGLE_API_KEY"])
+        inline_requests = [
+            {
+                "contents": [{"role": "user", "parts": [{"text": prompt + _PROMPT_SEPARATOR + data}]}],
+                "config": generation_config or {},
+            }
+            for data in inputs
+        ]
+        job = client.batches.create(model=MODEL_NAME, src=inline_requests)
+
+        status = st.empty()
+        while job.state.name not in BATCH_DONE_STATES:
+            status.text(f"Batch job {job.name} is {job.state.name}. Checking again in {BATCH_POLL_SECONDS}s...")
+            time.sleep(BATCH_POLL_SECONDS)
+            job = client.batches.get(name=job.name)
+        status.empty()
+    except Exception as e:
+        st.error(f"Batch API Error: {e}")
+        return [None] * len(inputs)
+
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        st.error(f"Batch job finished with state {job.state.name}.")
+        return [None] * len(inputs)
+
+    responses = []
+    for inline_response in job.dest.inlined_responses:
+        if inline_response.error or not inline_response.response:
+            responses.append(None)
+        else:
+            responses.append(inline_response.response.text)
+    return responses
+
+def clean_text_regex(text):
+    """
+    Fixes the mechanical PDF extraction artifacts that the Cleaner Agent used to handle.
+    """
+    for pattern, replacement in _CLEAN_RES:
+        text = pattern.sub(replacement, text)
+    return text
+
+def strip_boilerplate(text):
+    """
+    Drops running headers and footers, Safe Harbor sections and blank lines from extracted text,
+    and collapses runs of spaces. Line breaks are kept, since sections are split at speaker turns.
+    """
+    pages = [
+        [" ".join(words) for words in map(str.split, page.splitlines()) if words]
+        for page in text.split(PAGE_BREAK)
+    ]
+    page_keys = [_header_footer_keys(page) for page in pages]
+    repeated = set()
+    if len(pages) >= BOILERPLATE_MIN_PAGES:
+        line_counts = Counter(key for keys in page_keys for key in set(keys.values()))
+        repeated = {key for key, count in line_counts.items() if count >= BOILERPLATE_PAGE_SHARE * len(pages)}
+    text = "\n".join(
+        line
+        for page, keys in zip(pages, page_keys)
+        for index, line in enumerate(page)
+        if keys.get(index) not in repeated
+    )
+    return _SAFE_HARBOR_RE.sub("", text)
+
+def _header_footer_keys(page):
+    """
+    Maps the line numbers of a page's first and last BOILERPLATE_EDGE_LINES lines (speaker labels
+    excepted) to what they are compared by across pages: "#" for a page number, else the line itself.
+    """
+    edge_indices = set(range(min(BOILERPLATE_EDGE_LINES, len(page))))
+    edge_indices.update(range(max(len(page) - BOILERPLATE_EDGE_LINES, 0), len(page)))
+    return {
+        index: "#" if _PAGE_NUMBER_RE.fullmatch(page[index]) else page[index]
+        for index in edge_indices
+        if not _SPEAKER_LINE_RE.match(page[index])
+    }
+
+def residual_messiness(text):
+    """
+    Fraction of words that still look like several words glued together.
+    """
+    word_count = len(text.split())
+    return len(_GLUED_WORD_RE.findall(text)) / word_count if word_count else 0.0
+
+def llm_clean_text(text):
+    """
+    Runs the Cleaner Agent over the text in concurrent windows. Returns None if any window fails.
+    """
+    windows = split_text(text, CLEANER_WINDOW_CHARS)
+    cleaned_windows = gather_gemini(
+        cleaner_agent_prompt, windows, generation_config=CLEANER_GENERATION_CONFIG, model_name=LITE_MODEL_NAME
+    )
+    if not all(cleaned_windows):
+        return None
+    return " ".join(window.strip() for window in cleaned_windows)
+
+def fits_in_context(text):
+    """
+    Whether text fits in one request, by a local estimate (count_tokens would cost a round trip).
+    """
+    return len(text) / CHARS_PER_TOKEN <= MODEL_CONTEXT_TOKENS - PROMPT_HEADROOM_TOKENS
+
+def split_text(text, max_chars):
+    """
+    Splits text into pieces of at most max_chars, breaking on whitespace where possible.
+    """
+    pieces = []
+    start = 0
+    while len(text) - start > max_chars:
+        end = text.rfind(" ", start, start + max_chars)
+        if end <= start:
+            end = start + max_chars
+        pieces.append(text[start:end])
+        start = end
+    pieces.append(text[start:])
+    return pieces
+
+def split_into_sections(text, max_chars):
+    """
+    Packs whole speaker turns into sections of at most max_chars.
+    A single turn longer than max_chars is split on whitespace.
+    """
+    sections = []
+    current = ""
+    for turn in _SPEAKER_TURN_RE.split(text):
+        if current and len(current) + len(turn) + 1 > max_chars:
+            sections.append(current)
+            current = ""
+        if len(turn) > max_chars:
+            sections.extend(split_text(turn, max_chars))
+            continue
+        current = f"{current}\n{turn}" if current else turn
+    if current:
+        sections.append(current)
+    return sections
+
+def parse_analyzer_response(response_text):
+    """
+    Parses one section's Analyzer response. Raises ValueError unless it is a JSON object
+    whose ANALYZER_KEYS (where present) are lists of strings, as merge_analyzer_results expects.
+    """
+    result = clean_json_response(response_text)
+    for key in ANALYZER_KEYS:
+        bullets = result.get(key)
+        if bullets is not None and not (
+            isinstance(bullets, list) and all(isinstance(bullet, str) for bullet in bullets)
+        ):
+            raise ValueError(f'"{key}" is not a list of strings')
+    return result
+
+def merge_analyzer_results(section_results):
+    """
+    Concatenates each key's bullet list across the per-section Analyzer results.
+    Bullets repeated by several sections (ignoring case and spacing) are kept once.
+    """
+    merged = {}
+    for key in ANALYZER_KEYS:
+        seen = set()
+        merged[key] = []
+        for result in section_results:
+            for bullet in result.get(key) or []:
+                normalized = " ".join(bullet.lower().split())
+                if normalized not in seen:
+                    seen.add(normalized)
+                    merged[key].append(bullet)
+    return merged
+
+def analysis_size(analysis):
+    """
+    Total characters across all of the Analyzer's bullets.
+    """
+    return sum(len(bullet) for key in ANALYZER_KEYS for bullet in analysis[key])
+
+def report_from_analysis(analysis):
+    """
+    Maps merged Analyzer results onto the Report Writer's keys, for build_report_from_json.
+    """
+    risks = analysis["risk_factors"] + analysis["red_flags"]
+    return {
+        "executive_summary": (
+            f"Report covers {len(analysis['key_numbers'])} metrics, "
+            f"{len(analysis['strategic_updates'])} developments and {len(risks)} risks."
+        ),
+        "key_metrics": analysis["key_numbers"],
+        "strategic_developments": analysis["strategic_updates"],
+        "risks_and_red_flags": risks,
+    }
+
+def _extract_page_text(pdf, page_index):
+    """
+    Extracts one page's text, freeing PDFium's native page objects straight away
+    instead of leaving them for the garbage collector.
+    """
+    page = pdf[page_index]
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+        page.close()
+
+def _extract_pages(pdf_bytes, page_indices):
+    """
+    Extracts the text of the given pages. Runs in a worker process, so it opens its own copy of the PDF.
+    """
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        texts = [_extract_page_text(pdf, i) for i in page_indices]
+    finally:
+        pdf.close()
+    return PAGE_BREAK.join(texts)
+
+@st.cache_resource
+def get_pdf_text_cache():
+    """
+    Opens the on-disk cache of extracted PDF text. It outlives app restarts and is shared by every session.
+    """
+    import diskcache
+
+    return diskcache.Cache(PDF_CACHE_DIR)
+
+@st.cache_data(show_spinner=False)
+def extract_pdf_text(pdf_sha, _pdf_bytes):
+    """
+    Returns the text of every page, separated by PAGE_BREAK. Cached in memory and on disk by the SHA-256 of the PDF,
+    so repeat uploads skip extraction entirely. Only pdf_sha is hashed by Streamlit.
+    """
+    pdf_text_cache = get_pdf_text_cache()
+    cache_key = f"{PDF_CACHE_FORMAT}:{pdf_sha}"
+    full_text = pdf_text_cache.get(cache_key)
+    if full_text is None:
+        full_text = _extract_pdf_text_uncached(_pdf_bytes)
+        pdf_text_cache.set(cache_key, full_text)
+    return full_text
+
+def _extract_pdf_text_uncached(pdf_bytes):
+    """
+    Extracts the text of every page, splitting long PDFs across up to one worker process per CPU.
+    PDFium is not thread-safe, so the pages are split across processes rather than threads.
+    """
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    page_count = len(pdf)
+    pdf.close()
+    if page_count == 0:
+        return ""
+
+    # Each worker must be worth its start-up cost, so short PDFs are read in-process.
+    worker_count = min(os.cpu_count() or 1, -(-page_count // MIN_PAGES_PER_WORKER))
+    if worker_count == 1:
+        return _extract_pages(pdf_bytes, range(page_count))
+
+    pages_per_worker = -(-page_count // worker_count)
+    page_chunks = [
+        range(start, min(start + pages_per_worker, page_count))
+        for start in range(0, page_count, pages_per_worker)
+    ]
+    with ProcessPoolExecutor(max_workers=len(page_chunks)) as pool:
+        return PAGE_BREAK.join(pool.map(_extract_pages, repeat(pdf_bytes), page_chunks))
+
 # --- Main Application (The New "Factory Floor") ---
+# The pipeline's stored outputs, in order. Rerunning a stage also forgets every stage after it.
+PIPELINE_STAGES = ["clean", "analyzer", "final"]
+
+def request_stage_rerun(pdf_sha, stages):
+    """
+    on_click callback for a "Rerun this stage" button, run before the rerun the click triggers.
+    Drops the stored outputs of the given stages and lets that rerun compute them again.
+    """
+    results = st.session_state.pipeline_results.get(pdf_sha, {})
+    for stage in stages:
+        results.pop(stage, None)
+    st.session_state.run_requested = True
+
+def stage_rerun_button(pdf_sha, stages):
+    """
+    Draws the "Rerun this stage" button for stages[0], which also reruns the stages after it.
+    """
+    st.button("Rerun this stage", key=f"rerun_{stages[0]}", on_click=request_stage_rerun, args=(pdf_sha, stages))
+
+def fail_stage(pdf_sha, message):
+    """
+    Shows a stage's error and ends the run. The PDF's stored outputs are dropped, so later
+    widget clicks don't quietly retry the failed call; "Generate Summary" starts over.
+    """
+    st.session_state.pipeline_results.pop(pdf_sha, None)
+    st.error(message)
+    st.stop()
 
 def main():
     """
@@ -120,72 +843,193 @@ def main():
     st.set_page_config(layout="wide")
     st.title("Earnings Call Summarizer")
 
+    # Stage outputs per PDF (keyed by its SHA-256), so widget clicks redraw them instead of calling Gemini again.
+    if "pipeline_results" not in st.session_state:
+        st.session_state.pipeline_results = {}
+    # Only a button pressed on this run may start Gemini calls. Any other rerun (a checkbox,
+    # an expander) just redraws the stored stages.
+    run_requested = st.session_state.pop("run_requested", False)
+
+    if st.sidebar.button("Clear cached responses"):
+        _cached_gemini.clear()
+        st.session_state.pipeline_results = {}
+        st.sidebar.success("Cached Gemini responses cleared.")
+
     uploaded_file = st.file_uploader("Upload an Earnings Call Transcript (PDF)", type=["pdf"])
+    debug_mode = st.checkbox(
+        "Debug mode: run the step-by-step Cleaner / Analyzer / Synthesizer pipeline (slower)"
+    )
+    batch_mode = st.checkbox("Batch mode (cheaper, slower): submit the analysis as a Gemini batch job")
+    hedge_requests = st.checkbox(
+        f"Hedge requests (faster worst case, {HEDGE_COPIES}x API cost): send each analysis call "
+        f"{HEDGE_COPIES} times and keep the first valid answer"
+    )
 
     if uploaded_file:
+        # Read the upload once; the same bytes serve as hash input and parser input.
+        pdf_bytes = uploaded_file.getvalue()
+        pdf_sha = hashlib.sha256(pdf_bytes).hexdigest()
         if st.button("Generate Summary"):
-            if model is None:
+            st.session_state.pipeline_results.setdefault(pdf_sha, {})
+            run_requested = True
+
+        # Runs after "Generate Summary", and on every later rerun for the same PDF,
+        # where stored stages are shown again without another call.
+        results = st.session_state.pipeline_results.get(pdf_sha)
+        if results is not None:
+            if run_requested and get_model() is None:
                 st.error("Model not configured. Check API key in Streamlit Secrets.")
                 st.stop()
 
-            # --- This block runs when the user clicks the button ---
             with st.spinner("Processing... This may take 1-2 minutes."):
                 
                 # --- Step 1: Read the PDF ---
                 full_text = ""
                 try:
-                    with pdfplumber.open(uploaded_file) as pdf:
-                        full_text = " ".join(page.extract_text() for page in pdf.pages if page.extract_text())
+                    full_text = extract_pdf_text(pdf_sha, pdf_bytes)
                     st.info("PDF Read Successfully.")
                 except Exception as e:
-                    st.error(f"Error reading PDF: {e}")
-                    st.stop()
+                    fail_stage(pdf_sha, f"Error reading PDF: {e}")
+
+                # Drop headers, footers and legal boilerplate, then fix glued numbers and
+                # punctuation, before any LLM sees (and bills for) the text.
+                clean_text = clean_text_regex(strip_boilerplate(full_text))
                 
-                # --- Step 2: Call Agent 1 (Cleaner) ---
-                st.subheader("Step 1: Cleaning Raw Text")
-                clean_text = None
-                with st.expander("See Cleaner Details"):
-                    clean_text = call_gemini(cleaner_agent_prompt, full_text)
-                    if not clean_text:
-                        st.error("Cleaner Agent failed.")
-                        st.stop()
-                    st.text("Raw text has been cleaned by the AI.")
-                    # st.text(clean_text) # Uncomment to debug
-
-                # --- Step 3: Call Agent 2 (Analyzer) ---
-                st.subheader("Step 2: Analyzing Clean Text")
-                analyzer_json_text = None
-                if clean_text:
-                    with st.expander("See Analyzer Details"):
-                        analyzer_response_text = call_gemini(analyzer_agent_prompt, clean_text)
-                        if not analyzer_response_text:
-                            st.error("Analyzer Agent failed.")
-                            st.stop()
-                        
-                        analyzer_json_text = clean_json_response(analyzer_response_text)
-                        st.json(analyzer_json_text)
-
-                # --- Step 4: Call Agent 3 (Synthesizer) ---
-                st.subheader("Step 3: Synthesizing Final Report")
-                final_report_text = None
-                if analyzer_json_text:
-                    with st.expander("See Synthesizer Details"):
-                        final_report_text = call_gemini(synthesizer_agent_prompt, analyzer_json_text)
-                        if not final_report_text:
-                            st.error("Synthesizer Agent failed.")
-                            st.stop()
-                        
-                        st.text("Synthesizer received the JSON and produced this report:")
+                # Too long for one request? Route to the sectioned pipeline before paying for a failed call.
+                run_pipeline = debug_mode or not fits_in_context(clean_text)
+                if run_pipeline and not debug_mode:
+                    st.info("This transcript is too long for a single request, so it will be analyzed in sections.")
+
+                # E.g. Debug mode was toggled after generating: the other path's stages wait for a button.
+                needed_stages = PIPELINE_STAGES if run_pipeline else ["report"]
+                if not run_requested and not all(stage in results for stage in needed_stages):
+                    st.info("Press Generate Summary to run the remaining steps for this PDF.")
+                    st.stop()
+
+                final_report_stream = None
+                # Balloons only for a report produced on this run, not for one redrawn from session state.
+                report_is_new = False
+                if not run_pipeline:
+                    # --- Step 2: Call the Report Writer (single pass) ---
+                    st.subheader("Step 1: Writing the Report")
+                    stage_rerun_button(pdf_sha, ["report"])
+                    final_report_text = results.get("report")
+                    if final_report_text is None:
+                        report_response_text = run_json_agent(
+                            report_agent_prompt, [clean_text], generation_config=REPORT_GENERATION_CONFIG,
+                            batch_mode=batch_mode, hedge_requests=hedge_requests,
+                        )[0]
+                        if not report_response_text:
+                            fail_stage(pdf_sha, "Report Agent failed.")
+
+                        try:
+                            final_report_text = build_report_from_json(clean_json_response(report_response_text))
+                        except ValueError as e:
+                            fail_stage(pdf_sha, f"Report Agent returned invalid JSON: {e}")
+                        results["report"] = final_report_text
+                        report_is_new = True
+
+                else:
+                    # --- Step 2: Call Agent 1 (Cleaner), only if the regexes left glued words ---
+                    st.subheader("Step 1: Cleaning Raw Text")
+                    stage_rerun_button(pdf_sha, PIPELINE_STAGES)
+                    with st.expander("See Cleaner Details"):
+                        if "clean" in results:
+                            clean_text = results["clean"]
+                            st.text("Showing the cleaned text from an earlier run.")
+                        else:
+                            messiness = residual_messiness(clean_text)
+                            if messiness > CLEANER_MESSINESS_THRESHOLD:
+                                clean_text = llm_clean_text(clean_text)
+                                if not clean_text:
+                                    fail_stage(pdf_sha, "Cleaner Agent failed.")
+                                st.text(f"{messiness:.2%} of words were still run together, so the Cleaner Agent rewrote the text.")
+                            else:
+                                st.text(f"Only {messiness:.2%} of words are run together after regex cleaning; Cleaner Agent skipped.")
+                            results["clean"] = clean_text
+
+                    # --- Step 3: Call Agent 2 (Analyzer) ---
+                    st.subheader("Step 2: Analyzing Clean Text")
+                    stage_rerun_button(pdf_sha, PIPELINE_STAGES[1:])
+                    analyzer_json_text = results.get("analyzer")
+                    analysis = orjson.loads(analyzer_json_text) if analyzer_json_text else None
+                    if clean_text and analyzer_json_text is None:
+                        with st.expander("See Analyzer Details"):
+                            # Sections are independent, so they are analyzed concurrently.
+                            sections = split_into_sections(clean_text, ANALYZER_SECTION_CHARS)
+                            section_progress = st.progress(0.0, text=f"Analyzing {len(sections)} section(s)...")
+                            sections_done = 0
+
+                            def on_section_done():
+                                nonlocal sections_done
+                                sections_done += 1
+                                section_progress.progress(
+                                    sections_done / len(sections),
+                                    text=f"Analyzed {sections_done} of {len(sections)} section(s).",
+                                )
+
+                            analyzer_responses = run_json_agent(
+                                analyzer_agent_prompt, sections, generation_config=ANALYZER_GENERATION_CONFIG,
+                                batch_mode=batch_mode, hedge_requests=hedge_requests, on_done=on_section_done,
+                            )
+
+                            section_results = []
+                            for number, analyzer_response_text in enumerate(analyzer_responses, start=1):
+                                if not analyzer_response_text:
+                                    fail_stage(pdf_sha, f"Analyzer Agent failed on section {number}.")
+                                try:
+                                    section_results.append(parse_analyzer_response(analyzer_response_text))
+                                except ValueError as e:
+                                    fail_stage(pdf_sha, f"Analyzer Agent returned invalid JSON for section {number}: {e}")
+
+                            analysis = merge_analyzer_results(section_results)
+                            analyzer_json_text = orjson.dumps(analysis).decode()
+                            results["analyzer"] = analyzer_json_text
+                            st.json(analyzer_json_text)
+                    elif analyzer_json_text:
+                        with st.expander("See Analyzer Details"):
+                            st.json(analyzer_json_text)
+
+                    # --- Step 4: Call Agent 3 (Synthesizer) ---
+                    # The Synthesizer is streamed: the generator only starts the call
+                    # when Step 5 iterates it, so the report appears as it is written.
+                    st.subheader("Step 3: Synthesizing Final Report")
+                    stage_rerun_button(pdf_sha, PIPELINE_STAGES[2:])
+                    final_report_text = results.get("final")
+                    if analyzer_json_text and final_report_text is None:
+                        report_is_new = True
+                        with st.expander("See Synthesizer Details"):
+                            if analysis_size(analysis) < SYNTHESIZER_MIN_CHARS:
+                                # Too little material to be worth an LLM call; lay it out directly.
+                                final_report_text = build_report_from_json(report_from_analysis(analysis))
+                                results["final"] = final_report_text
+                                st.text("Analyzer output is short, so the report was built without the Synthesizer.")
+                            else:
+                                final_report_stream = stream_gemini(
+                                    synthesizer_agent_prompt, analyzer_json_text,
+                                    generation_config=SYNTHESIZER_GENERATION_CONFIG,
+                                )
+                                st.text("Synthesizer received the JSON and is streaming the report below.")
 
                 # --- Step 5: Display the Final Product ---
+                st.subheader("Your Executive Summary")
+                # Use st.text to display plain text perfectly
+                report_area = st.empty()
+                if final_report_stream is not None:
+                    final_report_text = ""
+                    for text_chunk in final_report_stream:
+                        final_report_text += text_chunk
+                        report_area.text(final_report_text)
+                    if final_report_text:
+                        results["final"] = final_report_text
+
                 if final_report_text:
-                    st.subheader("Your Executive Summary")
-                    # Use st.text to display plain text perfectly
-                    st.text(final_report_text)
-                    st.balloons()
+                    report_area.text(final_report_text)
+                    if report_is_new:
+                        st.balloons()
                 else:
-                    st.error("Could not generate the final report.")
+                    fail_stage(pdf_sha, "Could not generate the final report.")
 
 # This makes the script runnable
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()